@@ -44,17 +44,22 @@
 # application, after stripping the prefix "IOS_".
 
 import collections.abc
+import concurrent.futures
 import contextlib
+import functools
+import glob
 import json
 import logging
 import os
 import os.path
 import platform
 import plistlib
+import re
 import shutil
 import subprocess
 import tempfile
 import time
+import xml.parsers.expat
 import zipfile
 
 logging.basicConfig(
@@ -66,6 +71,28 @@ logger = logging.getLogger(__name__)
 if platform.system() != "Darwin":
   raise Exception("Cannot run iOS targets on a non-mac machine.")
 
+# Where CoreSimulator keeps one `<udid>/device.plist` per simulator device.
+CORESIMULATOR_DEVICES_PATH = os.path.expanduser(
+    "~/Library/Developer/CoreSimulator/Devices")
+
+# Maps the integer `state` in a CoreSimulator `device.plist` to the state
+# string reported by `simctl list`.
+CORESIMULATOR_DEVICE_STATES = {
+    0: "Creating",
+    1: "Shutdown",
+    2: "Booting",
+    3: "Booted",
+    4: "Shutting Down",
+}
+
+# Where `load_simctl_list()` caches the output of `simctl list -j` when the
+# RULES_APPLE_SIMCTL_CACHE environment variable is set to "1".
+SIMCTL_LIST_CACHE_PATH = os.path.join(tempfile.gettempdir(),
+                                      "rules_apple_simctl_cache.json")
+
+# How long a cached `simctl list -j` result stays fresh.
+SIMCTL_LIST_CACHE_TTL_SECONDS = 5
+
 
 class DeviceType(collections.abc.Mapping):
   """Wraps the `devicetype` dictionary from `simctl list -j`.
@@ -75,9 +102,26 @@ class DeviceType(collections.abc.Mapping):
   newer device types are sorted after older device types.
   """
 
+  __slots__ = ("device_type", "simctl_list_index", "max_runtime_version",
+               "_is_iphone", "_is_ipad", "sort_key")
+
   def __init__(self, device_type, simctl_list_index):
     self.device_type = device_type
     self.simctl_list_index = simctl_list_index
+    # `maxRuntimeVersion` is normally already an integer in the form returned
+    # by `minimum_os_to_simctl_runtime_version()`; parse it if it's a dotted
+    # version string, since comparing strings to integers is meaningless.
+    max_runtime_version = device_type.get("maxRuntimeVersion")
+    if isinstance(max_runtime_version, str):
+      max_runtime_version = minimum_os_to_simctl_runtime_version(
+          max_runtime_version)
+    self.max_runtime_version = max_runtime_version
+    # These are checked repeatedly while filtering and sorting.
+    self._is_iphone = self.has_product_family_or_identifier("iPhone")
+    self._is_ipad = self.has_product_family_or_identifier("iPad")
+    # Order iPhones ahead of (later in the list than) iPads. Order device
+    # types from the same product family in the same order as `simctl list`.
+    self.sort_key = (self._is_iphone, self.simctl_list_index)
 
   def __getitem__(self, name):
     return self.device_type[name]
@@ -92,20 +136,13 @@ class DeviceType(collections.abc.Mapping):
     return self["name"] + " (" + self["identifier"] + ")"
 
   def __lt__(self, other):
-    # Order iPhones ahead of (later in the list than) iPads.
-    if self.is_ipad() and other.is_iphone():
-      return True
-    elif self.is_iphone() and other.is_ipad():
-      return False
-    # Order device types from the same product family in the same order
-    # as `simctl list`.
-    return self.simctl_list_index < other.simctl_list_index
+    return self.sort_key < other.sort_key
 
   def is_iphone(self):
-    return self.has_product_family_or_identifier("iPhone")
+    return self._is_iphone
 
   def is_ipad(self):
-    return self.has_product_family_or_identifier("iPad")
+    return self._is_ipad
 
   def has_product_family_or_identifier(self, device_type):
     product_family = self.get("productFamily")
@@ -119,13 +156,16 @@ class DeviceType(collections.abc.Mapping):
 class Device(collections.abc.Mapping):
   """Wraps the `device` dictionary from `simctl list -j`.
 
-  Provides an ordering so booted devices > shutdown devices, delegating
-  to `DeviceType` order when both devices have the same state.
+  Provides an ordering so booted devices > devices in any other state,
+  delegating to `DeviceType` order otherwise.
   """
 
+  __slots__ = ("device", "device_type", "sort_key")
+
   def __init__(self, device, device_type):
     self.device = device
     self.device_type = device_type
+    self.sort_key = (self.is_booted(), device_type.sort_key)
 
   def is_shutdown(self):
     return self["state"] == "Shutdown"
@@ -146,14 +186,10 @@ class Device(collections.abc.Mapping):
     return self["name"] + "(" + self["udid"] + ")"
 
   def __lt__(self, other):
-    if self.is_shutdown() and other.is_booted():
-      return True
-    elif self.is_booted() and other.is_shutdown():
-      return False
-    else:
-      return self.device_type < other.device_type
+    return self.sort_key < other.sort_key
 
 
+@functools.lru_cache(maxsize=64)
 def minimum_os_to_simctl_runtime_version(minimum_os):
   """Converts a minimum OS string to a simctl RuntimeVersion integer.
 
@@ -165,11 +201,262 @@ def minimum_os_to_simctl_runtime_version(minimum_os):
     the minor version, and CC is the micro version.
   """
   # Pad the minimum OS version to major.minor.micro.
-  minimum_os_components = (minimum_os.split(".") + ["0"] * 3)[:3]
-  result = 0
-  for component in minimum_os_components:
-    result = (result << 8) | int(component)
-  return result
+  major, minor, micro, *_ = minimum_os.split(".") + ["0"] * 3
+  return (int(major) << 16) | (int(minor) << 8) | int(micro)
+
+
+def simctl_list_cache_key(simctl_path):
+  """Returns the key invalidating cached `simctl list -j` output.
+
+  The key changes when `xcode-select` points at a different Xcode, when the
+  selected Xcode is updated, or when simulators are created or deleted.
+
+  Args:
+    simctl_path: The path to the `simctl` binary.
+  """
+  try:
+    devices_mtime = os.stat(CORESIMULATOR_DEVICES_PATH).st_mtime
+  except OSError:
+    devices_mtime = None
+  return [simctl_path, os.stat(simctl_path).st_mtime, devices_mtime]
+
+
+def read_simctl_list_cache(cache_key):
+  """Returns cached `simctl list -j` data, or None if missing or stale."""
+  try:
+    cache_age = time.time() - os.stat(SIMCTL_LIST_CACHE_PATH).st_mtime
+    if cache_age > SIMCTL_LIST_CACHE_TTL_SECONDS:
+      return None
+    with open(SIMCTL_LIST_CACHE_PATH, mode="rb") as cache_file:
+      cache = json.load(cache_file)
+    if cache["key"] != cache_key:
+      return None
+    return cache["simctl_data"]
+  except (OSError, ValueError, KeyError, TypeError):
+    return None
+
+
+def write_simctl_list_cache(cache_key, simctl_data):
+  """Atomically replaces the cached `simctl list -j` data."""
+  fd, temp_path = tempfile.mkstemp(
+      dir=os.path.dirname(SIMCTL_LIST_CACHE_PATH), prefix="bazel_temp")
+  try:
+    with os.fdopen(fd, mode="w", encoding="utf-8") as cache_file:
+      json.dump({"key": cache_key, "simctl_data": simctl_data}, cache_file)
+    os.replace(temp_path, SIMCTL_LIST_CACHE_PATH)
+  except OSError:
+    logger.debug("Failed to write simctl list cache.", exc_info=True)
+    with contextlib.suppress(OSError):
+      os.remove(temp_path)
+
+
+def prune_simctl_list(simctl_data):
+  """Drops the parts of `simctl list -j` output that are never used.
+
+  Watch pairs, unavailable runtimes and unavailable devices are removed
+  here, in one place, so callers and the cache only see usable entries.
+
+  Args:
+    simctl_data: The parsed output of `simctl list -j`.
+
+  Returns:
+    A dictionary with the `devicetypes`, `runtimes` and `devices` keys.
+  """
+  runtimes = [
+      runtime for runtime in simctl_data["runtimes"] if runtime["isAvailable"]
+  ]
+  available_runtime_identifiers = {
+      runtime["identifier"] for runtime in runtimes
+  }
+  devices = {}
+  for runtime_identifier, runtime_devices in simctl_data["devices"].items():
+    if runtime_identifier not in available_runtime_identifiers:
+      continue
+    devices[runtime_identifier] = [
+        device for device in runtime_devices if device["isAvailable"]
+    ]
+  return {
+      "devicetypes": simctl_data["devicetypes"],
+      "runtimes": runtimes,
+      "devices": devices,
+  }
+
+
+def load_simctl_list(simctl_path):
+  """Returns the parsed and pruned output of `simctl list -j`.
+
+  If the RULES_APPLE_SIMCTL_CACHE environment variable is set to "1", reuses
+  the output of a recent invocation for the same Xcode, if any.
+
+  Args:
+    simctl_path: The path to the `simctl` binary.
+
+  Raises:
+    subprocess.SubprocessError: if `simctl list` fails or times out.
+  """
+  use_cache = os.environ.get("RULES_APPLE_SIMCTL_CACHE") == "1"
+  if use_cache:
+    cache_key = simctl_list_cache_key(simctl_path)
+    simctl_data = read_simctl_list_cache(cache_key)
+    if simctl_data is not None:
+      logger.debug("Using cached simctl list output.")
+      return simctl_data
+  cmd = [simctl_path, "list", "-j"]
+  with subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=-1) as process:
+    simctl_data = prune_simctl_list(json.loads(process.stdout.read()))
+    if process.wait() != os.EX_OK:
+      raise subprocess.CalledProcessError(process.returncode, cmd)
+  if use_cache:
+    write_simctl_list_cache(cache_key, simctl_data)
+  return simctl_data
+
+
+def is_simulator_booted(simctl_path, udid):
+  """Returns True if the given simulator is booted.
+
+  `simctl getenv` only succeeds once the simulator is booted, and unlike
+  `simctl list` only queries that one device.
+
+  Args:
+    simctl_path: The path to the `simctl` binary.
+    udid: The identifier of the simulator to query.
+  """
+  getenv_result = subprocess.run(
+      [simctl_path, "getenv", udid, "SIMULATOR_UDID"],
+      stdout=subprocess.DEVNULL,
+      stderr=subprocess.DEVNULL,
+      check=False)
+  return getenv_result.returncode == os.EX_OK
+
+
+def is_runtime_available(simctl_path, runtime_identifier):
+  """Returns True if the given simulator runtime is installed and usable.
+
+  Args:
+    simctl_path: The path to the `simctl` binary.
+    runtime_identifier: The runtime identifier (e.g.
+      "com.apple.CoreSimulator.SimRuntime.iOS-13-2").
+
+  Raises:
+    subprocess.SubprocessError: if `simctl list` fails.
+  """
+  simctl_list_result = subprocess.run(
+      [simctl_path, "list", "-j", "runtimes"],
+      stdout=subprocess.PIPE,
+      check=True)
+  for runtime in json.loads(simctl_list_result.stdout)["runtimes"]:
+    if runtime["identifier"] == runtime_identifier:
+      return runtime["isAvailable"]
+  return False
+
+
+def load_device_plist(device_plist_path):
+  """Returns the contents of a CoreSimulator `device.plist`, or None.
+
+  Returns None if the file is missing, partially written or malformed, so a
+  single bad simulator cannot break discovery of the others.
+  """
+  try:
+    with open(device_plist_path, mode="rb") as device_plist_file:
+      device_plist = plistlib.load(device_plist_file)
+  except (OSError, ValueError, xml.parsers.expat.ExpatError):
+    return None
+  if not isinstance(device_plist, dict):
+    return None
+  return device_plist
+
+
+def discover_pinned_simulator(simctl_path, sim_device, sim_os_version):
+  """Finds a simulator matching an exact device and OS version on disk.
+
+  Reads the `device.plist` files CoreSimulator keeps for each simulator
+  instead of invoking `simctl list`, which is slow and enumerates every
+  device, runtime and device type. Matches are only returned if their
+  runtime is available, and the boot state of each match is queried in
+  parallel with `simctl getenv`.
+
+  Unlike `discover_best_compatible_simulator()`, this is an exact match on
+  the device type identifier guessed from `sim_device` (e.g. "iPhone 8 Plus"
+  becomes "com.apple.CoreSimulator.SimDeviceType.iPhone-8-Plus"), not a
+  case-insensitive substring match on the device type name, and
+  `maxRuntimeVersion` is not checked. So "iPhone 8" only matches iPhone 8
+  simulators here, even if a booted iPhone 8 Plus simulator exists. If the
+  guessed identifier matches nothing, the caller falls back to `simctl list`.
+
+  Args:
+    simctl_path: The path to the `simctl` binary.
+    sim_device: Name of the device (e.g. "iPhone 8 Plus").
+    sim_os_version: Version of the iOS runtime (e.g. "13.2").
+
+  Returns:
+    A tuple (device_type, device) containing the DeviceType and Device
+    of the best matching simulator, or None if no match was found.
+
+  Raises:
+    subprocess.SubprocessError: if `simctl list` fails.
+  """
+  device_type_identifier = (
+      "com.apple.CoreSimulator.SimDeviceType." +
+      re.sub(r"[^A-Za-z0-9]+", "-", sim_device).strip("-"))
+  runtime_identifier = ("com.apple.CoreSimulator.SimRuntime.iOS-" +
+                        sim_os_version.replace(".", "-"))
+  device_type = DeviceType(
+      {
+          "name": sim_device,
+          "identifier": device_type_identifier,
+      }, 0)
+  matching_device_plists = []
+  for device_plist_path in glob.glob(
+      os.path.join(CORESIMULATOR_DEVICES_PATH, "*", "device.plist")):
+    device_plist = load_device_plist(device_plist_path)
+    if not device_plist or device_plist.get("isDeleted"):
+      continue
+    if not all(
+        isinstance(device_plist.get(key), str)
+        for key in ("UDID", "name", "deviceType")):
+      continue
+    if (device_plist["deviceType"].casefold() !=
+        device_type_identifier.casefold()):
+      continue
+    if device_plist.get("runtime") != runtime_identifier:
+      continue
+    matching_device_plists.append(device_plist)
+  logger.debug("Found %d simulators matching %s on disk.",
+               len(matching_device_plists), device_type_identifier)
+  if not matching_device_plists:
+    return None
+  # Simulators stay on disk after their runtime is uninstalled; `simctl list`
+  # reports them as unavailable, and they cannot be booted.
+  if not is_runtime_available(simctl_path, runtime_identifier):
+    logger.debug("Runtime %s is not available.", runtime_identifier)
+    return None
+  with concurrent.futures.ThreadPoolExecutor(
+      max_workers=min(8, len(matching_device_plists))) as executor:
+    booted = executor.map(
+        functools.partial(is_simulator_booted, simctl_path),
+        [device_plist["UDID"] for device_plist in matching_device_plists])
+    best_matching_device = None
+    for device_plist, is_booted in zip(matching_device_plists, booted):
+      state = CORESIMULATOR_DEVICE_STATES.get(
+          device_plist.get("state"), "Unknown")
+      # Trust `simctl getenv` over the state last written to disk.
+      if is_booted:
+        state = "Booted"
+      elif state == "Booted":
+        state = "Shutdown"
+      matching_device = Device(
+          {
+              "name": device_plist["name"],
+              "udid": device_plist["UDID"],
+              "state": state,
+              # Checked via the runtime above.
+              "isAvailable": True,
+              "deviceTypeIdentifier": device_plist["deviceType"],
+          }, device_type)
+      if (best_matching_device is None or
+          not matching_device < best_matching_device):
+        best_matching_device = matching_device
+  return (device_type, best_matching_device)
 
 
 def discover_best_compatible_simulator(simctl_path, minimum_os, sim_device,
@@ -189,71 +476,69 @@ def discover_best_compatible_simulator(simctl_path, minimum_os, sim_device,
   Raises:
     subprocess.SubprocessError: if `simctl list` fails or times out.
   """
+  if sim_device and sim_os_version:
+    pinned_simulator = discover_pinned_simulator(simctl_path, sim_device,
+                                                 sim_os_version)
+    if pinned_simulator:
+      return pinned_simulator
   # The `simctl list` CLI provides only very basic case-insensitive description
   # matching search term functionality.
   #
   # This code needs to enforce a numeric floor on `minimum_os`, so it directly
   # parses the JSON output by `simctl list` instead of repeatedly invoking
   # `simctl list` with search terms.
-  cmd = [simctl_path, "list", "-j"]
-  with subprocess.Popen(cmd, stdout=subprocess.PIPE) as process:
-    simctl_data = json.load(process.stdout)
-    if process.wait() != os.EX_OK:
-      raise subprocess.CalledProcessError(process.returncode, cmd)
-  compatible_device_types = []
+  simctl_data = load_simctl_list(simctl_path)
+  # Only the best device type and device are needed, so track the best seen
+  # so far instead of sorting. On ties the later one wins, as it would at the
+  # end of a stable sort.
+  compatible_device_types_by_identifier = {}
+  best_compatible_device_type = None
   minimum_runtime_version = minimum_os_to_simctl_runtime_version(minimum_os)
   # Prepare the device name for case-insensitive matching.
   sim_device = sim_device and sim_device.casefold()
   # `simctl list` orders device types from oldest to newest. Remember
   # the index of each device type to preserve that ordering when
-  # sorting device types.
+  # comparing device types.
   for (simctl_list_index, device_type) in enumerate(simctl_data["devicetypes"]):
     device_type = DeviceType(device_type, simctl_list_index)
     if not (device_type.is_iphone() or device_type.is_ipad()):
       continue
     # Some older simulators are missing `maxRuntimeVersion`. Assume those
     # simulators support all OSes (even though it's not true).
-    max_runtime_version = device_type.get("maxRuntimeVersion")
+    max_runtime_version = device_type.max_runtime_version
     if max_runtime_version and max_runtime_version < minimum_runtime_version:
       continue
     if sim_device and device_type["name"].casefold().find(sim_device) == -1:
       continue
-    compatible_device_types.append(device_type)
-  compatible_device_types.sort()
+    compatible_device_types_by_identifier[device_type["identifier"]] = (
+        device_type)
+    if (best_compatible_device_type is None or
+        not device_type < best_compatible_device_type):
+      best_compatible_device_type = device_type
   logger.debug("Found %d compatible device types.",
-               len(compatible_device_types))
+               len(compatible_device_types_by_identifier))
   compatible_runtime_identifiers = set()
+  # `load_simctl_list()` already dropped unavailable runtimes and devices.
   for runtime in simctl_data["runtimes"]:
-    if not runtime["isAvailable"]:
-      continue
     if sim_os_version and runtime["version"] != sim_os_version:
       continue
     compatible_runtime_identifiers.add(runtime["identifier"])
-  compatible_devices = []
+  compatible_device_count = 0
+  best_compatible_device = None
   for runtime_identifier, devices in simctl_data["devices"].items():
     if runtime_identifier not in compatible_runtime_identifiers:
       continue
     for device in devices:
-      if not device["isAvailable"]:
-        continue
-      compatible_device = None
-      for device_type in compatible_device_types:
-        if device["deviceTypeIdentifier"] == device_type["identifier"]:
-          compatible_device = Device(device, device_type)
-          break
-      if not compatible_device:
+      compatible_device_type = compatible_device_types_by_identifier.get(
+          device["deviceTypeIdentifier"])
+      if not compatible_device_type:
         continue
-      compatible_devices.append(compatible_device)
-  compatible_devices.sort()
-  logger.debug("Found %d compatible devices.", len(compatible_devices))
-  if compatible_device_types:
-    best_compatible_device_type = compatible_device_types[-1]
-  else:
-    best_compatible_device_type = None
-  if compatible_devices:
-    best_compatible_device = compatible_devices[-1]
-  else:
-    best_compatible_device = None
+      compatible_device = Device(device, compatible_device_type)
+      compatible_device_count += 1
+      if (best_compatible_device is None or
+          not compatible_device < best_compatible_device):
+        best_compatible_device = compatible_device
+  logger.debug("Found %d compatible devices.", compatible_device_count)
   return (best_compatible_device_type, best_compatible_device)
 
 
@@ -281,7 +566,10 @@ def persistent_ios_simulator(simctl_path, minimum_os, sim_device,
        simctl_path, minimum_os, sim_device, sim_os_version)
   if best_compatible_device:
     udid = best_compatible_device["udid"]
-    if best_compatible_device.is_shutdown():
+    # The state may come from the simctl list cache, which is not invalidated
+    # when a simulator boots, so check again before booting.
+    if (best_compatible_device.is_shutdown() and
+        not is_simulator_booted(simctl_path, udid)):
       logger.debug("Booting compatible device: %s", best_compatible_device)
       subprocess.run([simctl_path, "boot", udid], check=True)
     else:
@@ -304,6 +592,17 @@ def persistent_ios_simulator(simctl_path, minimum_os, sim_device,
       % (minimum_os, sim_device, sim_os_version))
 
 
+def simctl_supports_subcommand(simctl_path, subcommand):
+  """Returns True if `simctl help` lists the given subcommand."""
+  help_result = subprocess.run([simctl_path, "help"],
+                               encoding="utf-8",
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT,
+                               check=False)
+  return re.search(r"^\s+" + re.escape(subcommand) + r"\b",
+                   help_result.stdout, re.MULTILINE) is not None
+
+
 def wait_for_sim_to_boot(simctl_path, udid):
   """Blocks until the given simulator is booted.
 
@@ -315,21 +614,31 @@ def wait_for_sim_to_boot(simctl_path, udid):
     True if the simulator boots within 60 seconds, False otherwise.
   """
   logger.info("Waiting for simulator to boot...")
+  # `simctl bootstatus -b` blocks until the simulator has finished booting
+  # (booting it first if needed).
+  try:
+    bootstatus_result = subprocess.run(
+        [simctl_path, "bootstatus", udid, "-b"],
+        encoding="utf-8",
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        check=False,
+        timeout=60)
+  except subprocess.TimeoutExpired:
+    return False
+  if bootstatus_result.returncode == os.EX_OK:
+    logger.debug("Simulator is booted.")
+    return True
+  if simctl_supports_subcommand(simctl_path, "bootstatus"):
+    logger.error("simctl bootstatus failed: %s",
+                 bootstatus_result.stderr.rstrip())
+    return False
+  # Older versions of `simctl` lack `bootstatus`. Poll instead.
+  logger.debug("simctl bootstatus unsupported, polling simctl getenv instead.")
   for _ in range(0, 60):
-    # The expected output of "simctl list" is like:
-    # -- iOS 8.4 --
-    # iPhone 5s (E946FA1C-26AB-465C-A7AC-24750D520BEA) (Shutdown)
-    # TestDevice (8491C4BC-B18E-4E2D-934A-54FA76365E48) (Booted)
-    # So if there's any booted simulator, $booted_device will not be empty.
-    simctl_list_result = subprocess.run([simctl_path, "list", "devices"],
-                                        encoding="utf-8",
-                                        check=True,
-                                        stdout=subprocess.PIPE)
-    for line in simctl_list_result.stdout.split("\n"):
-      if line.find(udid) != -1 and line.find("Booted") != -1:
-        logger.debug("Simulator is booted.")
-        # Simulator is booted.
-        return True
+    if is_simulator_booted(simctl_path, udid):
+      logger.debug("Simulator is booted.")
+      return True
     logger.debug("Simulator not booted, still waiting...")
     time.sleep(1)
   return False
@@ -390,10 +699,6 @@ def temporary_ios_simulator(simctl_path, device, version):
                                         stdout=subprocess.PIPE)
   udid = simctl_create_result.stdout.rstrip()
   try:
-    logger.info("Killing all running simulators...")
-    subprocess.run(["pkill", "Simulator"],
-                   stderr=subprocess.DEVNULL,
-                   check=False)
     yield udid
   finally:
     logger.info("Shutting down simulator with udid: %s", udid)
@@ -404,6 +709,37 @@ def temporary_ios_simulator(simctl_path, device, version):
     subprocess.run([simctl_path, "delete", udid], check=True)
 
 
+def link_or_copy(src, dst):
+  """Hard links `src` to `dst`, falling back to a copy (e.g. across devices)."""
+  try:
+    os.link(src, dst)
+  except OSError:
+    shutil.copy2(src, dst)
+
+
+def link_tree(src, dst):
+  """Recreates the directory tree `src` at `dst` in a single pass.
+
+  Files are hard linked (see `link_or_copy()`) and keep their permissions,
+  since changing them would also change the original. Directories are new,
+  so they are made writable as they are created to allow cleaning up `dst`.
+  Like `shutil.copytree()`, follows symlinks and skips dangling ones.
+
+  Args:
+    src: The directory to recreate.
+    dst: The path of the directory to create.
+  """
+  os.mkdir(dst)
+  os.chmod(dst, 0o777)
+  with os.scandir(src) as entries:
+    for entry in entries:
+      dst_path = os.path.join(dst, entry.name)
+      if entry.is_dir():
+        link_tree(entry.path, dst_path)
+      elif entry.is_file():
+        link_or_copy(entry.path, dst_path)
+
+
 @contextlib.contextmanager
 def extracted_app(ios_application_output_path, app_name):
   """Extracts Foo.app from an ios_application() rule's output.
@@ -420,18 +756,22 @@ def extracted_app(ios_application_output_path, app_name):
     logger.debug("Found app directory: %s", ios_application_output_path)
     with tempfile.TemporaryDirectory(prefix="bazel_temp") as temp_dir:
       temp_app_path = os.path.join(temp_dir, app_name + ".app")
-      shutil.copytree(ios_application_output_path, temp_app_path)
-      for root, dirs, _ in os.walk(temp_app_path):
-        for directory in dirs:
-          os.chmod(os.path.join(root, directory), 0o777)
-      os.chmod(temp_app_path, 0o777)
+      link_tree(ios_application_output_path, temp_app_path)
       yield temp_app_path
   else:
     with tempfile.TemporaryDirectory(prefix="bazel_temp") as temp_dir:
       logger.debug("Unzipping IPA from %s to %s", ios_application_output_path,
                    temp_dir)
       with zipfile.ZipFile(ios_application_output_path) as ipa_zipfile:
-        ipa_zipfile.extractall(temp_dir)
+        # Only the app bundle is needed to launch the app; skip the rest of the
+        # IPA (e.g. Symbols/, SwiftSupport/).
+        app_prefix = "Payload/" + app_name + ".app/"
+        ipa_zipfile.extractall(
+            temp_dir,
+            members=[
+                name for name in ipa_zipfile.namelist()
+                if name.startswith(app_prefix)
+            ])
         yield os.path.join(temp_dir, "Payload", app_name + ".app")
 
 
@@ -439,8 +779,14 @@ def bundle_id(bundle_path):
   """Returns the bundle ID given a bundle directory path."""
   info_plist_path = os.path.join(bundle_path, "Info.plist")
   with open(info_plist_path, mode="rb") as plist_file:
-    plist = plistlib.load(plist_file)
-    return plist["CFBundleIdentifier"]
+    plist_data = plist_file.read()
+  # Pass the format explicitly rather than letting plistlib sniff it.
+  if plist_data.startswith(b"bplist00"):
+    plist_format = plistlib.FMT_BINARY
+  else:
+    plist_format = plistlib.FMT_XML
+  plist = plistlib.loads(plist_data, fmt=plist_format)
+  return plist["CFBundleIdentifier"]
 
 
 def simctl_launch_environ():
@@ -450,12 +796,11 @@ def simctl_launch_environ():
   # will be passed to the app as prefix to differentiate from other env vars. We
   # replace the prefix "IOS_" with "SIMCTL_CHILD_" here, because "simctl" only
   # pass the env vars prefixed with "SIMCTL_CHILD_" to the app.
-  result = {}
-  for k, v in os.environ.items():
-    if not k.startswith("IOS_"):
-      continue
-    new_key = k.replace("IOS_", "SIMCTL_CHILD_", 1)
-    result[new_key] = v
+  result = {
+      "SIMCTL_CHILD_" + k[len("IOS_"):]: v
+      for k, v in os.environ.items()
+      if k.startswith("IOS_")
+  }
   if 'IDE_DISABLED_OS_ACTIVITY_DT_MODE' not in os.environ:
     # Ensure os_log() mirrors writes to stderr. (lldb and Xcode set this
     # environment variable as well.)